@@ -6,24 +6,49 @@ Usage:
     python generate_timelapse.py input.json output.mp4 [--fps 30] [--speed 1.0]
 
 Requirements:
-    pip install pillow opencv-python numpy
+    pip install opencv-python numpy numba
+
+If an ffmpeg binary built with libx264 is on PATH, frames are piped to it;
+otherwise OpenCV's video writer is used.
+
+Without Numba, strokes fall back to OpenCV's round lines, which come out
+thinner than the app's square brush on diagonals.
+
+Optional:
+    pip install orjson   # faster JSON loading
 """
 
 import json
 import sys
 import argparse
+import queue
+import shutil
+import subprocess
+import threading
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict, Tuple
-from PIL import Image, ImageDraw
+from typing import List, Dict, Optional, Tuple
 import numpy as np
 import cv2
 
+try:
+    from numba import njit, prange
+except ImportError:  # Without Numba, fall back to OpenCV rasterization
+    njit = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the json module
+    orjson = None
+
 CANVAS_SIZE = 1080
+FRAME_QUEUE_SIZE = 4  # Frames buffered between rasterization and encoding
+HOLD_FRAMES = 30  # Extra copies of the finished drawing at the end of the video
 
 def load_strokes(json_path: str) -> Dict:
     """Load stroke data from JSON file."""
-    with open(json_path, 'r') as f:
-        data = json.load(f)
+    with open(json_path, 'rb') as f:
+        data = orjson.loads(f.read()) if orjson is not None else json.load(f)
     
     # Handle both old format (array) and new format (with metadata)
     if isinstance(data, dict) and 'strokes' in data:
@@ -33,35 +58,190 @@ def load_strokes(json_path: str) -> Dict:
     else:
         raise ValueError("Invalid JSON format")
 
+@lru_cache(maxsize=None)
 def hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     """Convert hex color to RGB tuple."""
-    hex_color = hex_color.lstrip('#')
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    value = int(hex_color.lstrip('#'), 16)
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
 
-def draw_stroke_segment(draw: ImageDraw.Draw, start: Tuple[float, float], 
-                       end: Tuple[float, float], color: Tuple[int, int, int], 
-                       brush_size: int):
-    """Draw a line segment between two points."""
-    if brush_size <= 0:
+if njit is not None:
+    @lru_cache(maxsize=None)
+    def make_stamper(brush_size: int):
+        """Compile a square-brush polyline stamper specialized for one brush
+        size, so the half width and step spacing are compile-time constants."""
+        half = brush_size / 2
+        spacing = brush_size / 4
+        
+        @njit(cache=True, fastmath=True, parallel=True)
+        def stamp_polyline(canvas, points, b, g, r):
+            # Stamp the brush along each segment as the canvas app does;
+            # segments run in parallel since they all write the same color
+            height, width = canvas.shape[0], canvas.shape[1]
+            for k in prange(len(points) - 1):
+                x0 = points[k, 0]
+                y0 = points[k, 1]
+                dx = points[k + 1, 0] - x0
+                dy = points[k + 1, 1] - y0
+                distance = (dx * dx + dy * dy) ** 0.5
+                if distance <= 0:
+                    continue
+                steps = max(1, int(distance / spacing))
+                # Step the stamp center incrementally (DDA) instead of
+                # interpolating from a fresh parameter on every stamp
+                step_x = dx / steps
+                step_y = dy / steps
+                x = x0
+                y = y0
+                for i in range(steps + 1):
+                    left = max(0, int(x - half))
+                    right = min(width, int(x + half) + 1)
+                    top = max(0, int(y - half))
+                    bottom = min(height, int(y + half) + 1)
+                    # Skip stamps that lie entirely off the canvas
+                    if left < right and top < bottom:
+                        canvas[top:bottom, left:right, 0] = b
+                        canvas[top:bottom, left:right, 1] = g
+                        canvas[top:bottom, left:right, 2] = r
+                    x += step_x
+                    y += step_y
+        
+        return stamp_polyline
+
+def draw_stroke_polyline(canvas: np.ndarray, points: np.ndarray,
+                         color: Tuple[int, int, int], brush_size: int):
+    """Draw connected segments through an (N, 2) array of points (color is BGR)."""
+    if len(points) < 2:
         return
     
-    # Draw filled rectangle for each point along the line
-    dx = end[0] - start[0]
-    dy = end[1] - start[1]
-    distance = (dx**2 + dy**2)**0.5
+    if njit is not None:
+        # Exact square-brush stamping, compiled to native code
+        stamp_polyline = make_stamper(int(brush_size))
+        stamp_polyline(canvas, np.ascontiguousarray(points, dtype=np.float64),
+                       color[0], color[1], color[2])
+        return
     
-    if distance > 0:
-        steps = max(1, int(distance / (brush_size / 4)))
-        for i in range(steps + 1):
-            t = i / steps
-            x = start[0] + dx * t
-            y = start[1] + dy * t
-            # Draw square brush
-            left = x - brush_size / 2
-            top = y - brush_size / 2
-            right = x + brush_size / 2
-            bottom = y + brush_size / 2
-            draw.rectangle([left, top, right, bottom], fill=color)
+    # One native call rasterizes the whole run of thick segments; square off
+    # each joint so strokes keep the square brush look instead of round caps
+    cv2.polylines(canvas, [points.astype(np.int32).reshape(-1, 1, 2)], False,
+                  color, thickness=int(brush_size), lineType=cv2.LINE_8)
+    for point in points[1:]:
+        draw_brush_point(canvas, point, color, brush_size)
+
+def draw_brush_point(canvas: np.ndarray, point: Tuple[float, float],
+                     color: Tuple[int, int, int], brush_size: int):
+    """Stamp a single square brush at a point (color is BGR)."""
+    half = brush_size / 2
+    height, width = canvas.shape[:2]
+    # Plain slice fill; NumPy lowers this to a tight store loop
+    left = max(0, int(point[0] - half))
+    right = min(width, int(point[0] + half) + 1)
+    top = max(0, int(point[1] - half))
+    bottom = min(height, int(point[1] + half) + 1)
+    if left < right and top < bottom:
+        canvas[top:bottom, left:right] = color
+
+class FFmpegWriter:
+    """Pipe raw BGR frames to an ffmpeg process encoding H.264 (libx264).
+    
+    The last frame is held for HOLD_FRAMES by ffmpeg's tpad filter, so the
+    hold is never written or encoded as separate frames."""
+    
+    def __init__(self, output_path: str, fps: int):
+        self.process = subprocess.Popen(
+            [
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                '-s', f'{CANVAS_SIZE}x{CANVAS_SIZE}', '-r', str(fps),
+                '-i', '-',
+                '-vf', f'tpad=stop_mode=clone:stop={HOLD_FRAMES}',
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23',
+                '-pix_fmt', 'yuv420p',
+                output_path,
+            ],
+            stdin=subprocess.PIPE,
+        )
+    
+    def write(self, frame: np.ndarray):
+        # Frames are C-contiguous, so their buffer is written without a copy
+        try:
+            self.process.stdin.write(frame.data)
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg exited with status {self.process.wait()}") from None
+    
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass  # ffmpeg already exited; its status is checked below
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with status {self.process.returncode}")
+
+def ffmpeg_has_libx264() -> bool:
+    """Check that an ffmpeg binary is on PATH and was built with libx264."""
+    if shutil.which('ffmpeg') is None:
+        return False
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return 'libx264' in result.stdout
+
+def open_video_writer(output_path: str, fps: int):
+    """Open an ffmpeg pipe if ffmpeg with libx264 is installed, else an OpenCV writer."""
+    if ffmpeg_has_libx264():
+        try:
+            return FFmpegWriter(output_path, fps)
+        except OSError as e:
+            print(f"Could not start ffmpeg ({e}), falling back to OpenCV")
+    return open_cv2_video_writer(output_path, fps)
+
+def open_cv2_video_writer(output_path: str, fps: int) -> cv2.VideoWriter:
+    """Open an H.264 writer with hardware acceleration, falling back to mp4v."""
+    frame_size = (CANVAS_SIZE, CANVAS_SIZE)
+    video_writer = cv2.VideoWriter(
+        output_path,
+        cv2.CAP_FFMPEG,
+        cv2.VideoWriter_fourcc(*'avc1'),
+        fps,
+        frame_size,
+        [
+            cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY,
+            cv2.VIDEOWRITER_PROP_DEPTH, cv2.CV_8U,
+            cv2.VIDEOWRITER_PROP_IS_COLOR, 1,
+        ]
+    )
+    if video_writer.isOpened():
+        return video_writer
+    
+    print("H.264 encoder unavailable, falling back to mp4v")
+    video_writer.release()
+    return cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, frame_size)
+
+def union_rect(a: Optional[Tuple[int, int, int, int]],
+               b: Optional[Tuple[int, int, int, int]]) -> Optional[Tuple[int, int, int, int]]:
+    """Smallest (x0, y0, x1, y1) rectangle covering both; None is empty."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+def write_frames(video_writer, frame_queue: queue.Queue, errors: List[Exception]):
+    """Encode frames from the queue until a None sentinel arrives.
+    
+    An encoding failure is stored in errors for the producer to re-raise;
+    the queue keeps being drained so the producer never blocks on it."""
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            break
+        if errors:
+            continue  # Encoding already failed; discard the frame
+        try:
+            video_writer.write(frame)
+        except Exception as e:
+            errors.append(e)
 
 def create_timelapse_video(strokes: List[Dict], output_path: str, 
                            fps: int = 30, speed: float = 1.0,
@@ -83,8 +263,20 @@ def create_timelapse_video(strokes: List[Dict], output_path: str,
     # Sort turns
     sorted_turn_numbers = sorted(turns.keys())
     
-    # Compress timeline: normalize timestamps within each turn, then sequence turns
-    all_points = []
+    # Compress timeline: normalize timestamps within each turn, then sequence turns.
+    # Points are stored as parallel NumPy columns (struct of arrays) with
+    # per-stroke lookup tables for color and brush size.
+    total_points = sum(len(s['points']) for s in strokes)
+    xs = np.empty(total_points, dtype=np.float64)
+    ys = np.empty(total_points, dtype=np.float64)
+    ts = np.empty(total_points, dtype=np.int64)
+    stroke_idx = np.empty(total_points, dtype=np.int32)
+    stroke_colors = np.empty((len(strokes), 3), dtype=np.uint8)  # BGR
+    stroke_brush = np.empty(len(strokes), dtype=np.int32)
+    stroke_bboxes = np.empty((len(strokes), 4), dtype=np.int32)  # x0, y0, x1, y1
+    num_points = 0
+    num_strokes = 0
+    degenerate_ts = []  # First/last compressed timestamps of strokes that draw nothing
     cumulative_time = 0
     
     for turn_num in sorted_turn_numbers:
@@ -92,317 +284,223 @@ def create_timelapse_video(strokes: List[Dict], output_path: str,
         # Sort strokes in this turn by timestamp
         turn_strokes.sort(key=lambda s: s['timestamp'])
         
-        # Find the first timestamp in this turn
-        turn_start_time = min(
-            min(p['timestamp'] for p in s['points']) 
+        # Collect each stroke's point timestamps once, then find the first
+        # and last timestamp in this turn
+        turn_ts = [
+            np.fromiter((p['timestamp'] for p in s['points']), dtype=np.int64, count=len(s['points']))
             for s in turn_strokes
-        )
+        ]
+        turn_start_time = int(min(stroke_ts.min() for stroke_ts in turn_ts))
+        turn_end_time = int(max(stroke_ts.max() for stroke_ts in turn_ts))
         
         # Add all points from this turn with compressed timestamps
-        for stroke in turn_strokes:
-            stroke_id = stroke['id']
-            color = hex_to_rgb(stroke['color'])
-            brush_size = stroke['brushSize']
+        for stroke, stroke_ts in zip(turn_strokes, turn_ts):
+            # Normalize timestamps relative to turn start, then add to cumulative time
+            compressed_ts = stroke_ts - turn_start_time + cumulative_time
             undone = stroke.get('undone', False)
             undone_at = stroke.get('undoneAt')
             
             # Calculate compressed timestamp for when undo was pressed (if applicable)
             compressed_undone_at = None
             if undone and undone_at:
-                # Find the point in this stroke that's closest to undone_at
-                # and calculate its compressed timestamp
-                for point in stroke['points']:
-                    if point['timestamp'] >= undone_at:
-                        relative_undone_time = point['timestamp'] - turn_start_time
-                        compressed_undone_at = cumulative_time + relative_undone_time
-                        break
-                # If no point found, use the last point's timestamp
-                if compressed_undone_at is None and stroke['points']:
-                    last_point = stroke['points'][-1]
-                    relative_undone_time = last_point['timestamp'] - turn_start_time
-                    compressed_undone_at = cumulative_time + relative_undone_time
+                # Binary search (timestamps increase along a stroke) for the
+                # first point at or after undone_at and calculate its
+                # compressed timestamp; if no point found, use the last point
+                undo_idx = min(int(np.searchsorted(stroke_ts, undone_at)), len(stroke_ts) - 1)
+                compressed_undone_at = int(compressed_ts[undo_idx])
             
-            for i, point in enumerate(stroke['points']):
-                # Normalize timestamp relative to turn start, then add to cumulative time
-                relative_time = point['timestamp'] - turn_start_time
-                compressed_timestamp = cumulative_time + relative_time
-                
-                # Skip points after undo timestamp
-                if undone and compressed_undone_at and compressed_timestamp > compressed_undone_at:
-                    continue
-                
-                all_points.append({
-                    'stroke_id': stroke_id,
-                    'point_index': i,
-                    'x': point['x'],
-                    'y': point['y'],
-                    'timestamp': compressed_timestamp,
-                    'color': color,
-                    'brush_size': brush_size,
-                    'stroke': stroke,
-                })
+            # Skip points after undo timestamp
+            keep = None
+            if undone and compressed_undone_at:
+                keep = compressed_ts <= compressed_undone_at
+                compressed_ts = compressed_ts[keep]
+            
+            if stroke['brushSize'] <= 0:
+                # Degenerate brush draws nothing, but its points still bound
+                # the video's time range
+                degenerate_ts += (int(compressed_ts[0]), int(compressed_ts[-1]))
+                continue
+            
+            s = num_strokes
+            num_strokes += 1
+            stroke_colors[s] = hex_to_rgb(stroke['color'])[::-1]
+            stroke_brush[s] = stroke['brushSize']
+            
+            # Region of the canvas this stroke can touch, padded by the brush
+            stroke_xs = np.array([p['x'] for p in stroke['points']], dtype=np.float64)
+            stroke_ys = np.array([p['y'] for p in stroke['points']], dtype=np.float64)
+            half = stroke['brushSize'] / 2
+            stroke_bboxes[s] = (
+                min(CANVAS_SIZE, max(0, int(stroke_xs.min() - half))),
+                min(CANVAS_SIZE, max(0, int(stroke_ys.min() - half))),
+                min(CANVAS_SIZE, max(0, int(stroke_xs.max() + half) + 1)),
+                min(CANVAS_SIZE, max(0, int(stroke_ys.max() + half) + 1)),
+            )
+            
+            if keep is not None:
+                stroke_xs = stroke_xs[keep]
+                stroke_ys = stroke_ys[keep]
+            
+            end = num_points + len(compressed_ts)
+            xs[num_points:end] = stroke_xs
+            ys[num_points:end] = stroke_ys
+            ts[num_points:end] = compressed_ts
+            stroke_idx[num_points:end] = s
+            num_points = end
         
         # Update cumulative time: add the duration of this turn
-        turn_end_time = max(
-            max(p['timestamp'] for p in s['points']) 
-            for s in turn_strokes
-        )
         turn_duration = turn_end_time - turn_start_time
         cumulative_time += turn_duration
     
-    # Sort by compressed timestamp
-    all_points.sort(key=lambda p: p['timestamp'])
-    
-    if not all_points:
+    if num_points == 0:
         print("No points to render!")
         return
     
+    # Drop slots left by undone points, then sort once by compressed timestamp
+    order = np.argsort(ts[:num_points], kind='stable')
+    xs = xs[order]
+    ys = ys[order]
+    ts = ts[order]
+    stroke_idx = stroke_idx[order]
+    
     # Calculate time range (now compressed, no gaps)
-    start_time = all_points[0]['timestamp']
-    end_time = all_points[-1]['timestamp']
+    start_time = min(int(ts[0]), *degenerate_ts)
+    end_time = max(int(ts[-1]), *degenerate_ts)
     duration_ms = end_time - start_time
     duration_seconds = (duration_ms / 1000.0) / speed
     
     print(f"Total duration: {duration_seconds:.2f} seconds")
     print(f"Start time: {start_time}, End time: {end_time}")
-    print(f"Total points: {len(all_points)}")
+    print(f"Total points: {num_points}")
     
     # Calculate frame interval
     frame_interval_ms = 1000.0 / fps / speed
-    total_frames = int(duration_seconds * fps)
+    total_frames = max(1, int(duration_seconds * fps))
     
     print(f"Generating {total_frames} frames at {fps} fps...")
     
-    # Create video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter(
-        output_path, 
-        fourcc, 
-        fps, 
-        (CANVAS_SIZE, CANVAS_SIZE)
-    )
+    # Create video writer; encoding runs on a background thread fed through a
+    # small bounded queue so it overlaps with rasterization
+    video_writer = open_video_writer(output_path, fps)
+    frame_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    writer_errors = []  # Filled by the writer thread if encoding fails
+    writer_thread = threading.Thread(target=write_frames, args=(video_writer, frame_queue, writer_errors), daemon=True)
+    writer_thread.start()
     
     # Initialize canvas
-    bg_color = hex_to_rgb(background_color)
-    canvas = Image.new('RGB', (CANVAS_SIZE, CANVAS_SIZE), bg_color)
-    draw = ImageDraw.Draw(canvas)
+    bg_bgr = hex_to_rgb(background_color)[::-1]
+    canvas = np.full((CANVAS_SIZE, CANVAS_SIZE, 3), bg_bgr, dtype=np.uint8)
+    
+    # Snapshot buffers are allocated once and reused round-robin. At most
+    # FRAME_QUEUE_SIZE + 1 of them are queued or being encoded at a time, so
+    # one spare guarantees the buffer being refilled is no longer in use.
+    # Each buffer tracks the canvas region drawn since it was last refilled,
+    # so refreshing it only copies that region.
+    frame_buffers = [canvas.copy() for _ in range(FRAME_QUEUE_SIZE + 2)]
+    stale_rects = [None] * len(frame_buffers)
+    snapshot_count = 0
     
-    # Track which strokes have been started
-    active_strokes = {}  # stroke_id -> current point index
-    completed_strokes = set()
+    # Last drawn point of each stroke, used to draw the next segment
+    last_xy = {}  # stroke index -> (x, y)
     
     # Process frames
     current_point_index = 0
-    all_points_processed = False
+    frame = None  # Snapshot of the canvas last handed to the writer thread
     
     for frame_num in range(total_frames):
-        # Calculate target time for this frame
-        frame_time = start_time + (frame_num * frame_interval_ms)
+        if writer_errors:
+            break  # Stop rendering frames that can no longer be encoded
         
-        # Draw all points up to current time
-        while current_point_index < len(all_points):
-            point_data = all_points[current_point_index]
-            
-            if point_data['timestamp'] > frame_time:
-                break
-            
-            stroke_id = point_data['stroke_id']
-            point_idx = point_data['point_index']
-            
-            # Start new stroke if needed
-            if stroke_id not in active_strokes:
-                active_strokes[stroke_id] = 0
-                # Redraw all completed strokes in chronological order
-                canvas = Image.new('RGB', (CANVAS_SIZE, CANVAS_SIZE), bg_color)
-                draw = ImageDraw.Draw(canvas)
-                # Get completed strokes and sort by timestamp to maintain proper layering
-                completed_stroke_list = [s for s in strokes if s['id'] in completed_strokes]
-                completed_stroke_list.sort(key=lambda s: s['timestamp'])
-                
-                for stroke in completed_stroke_list:
-                    # Handle undone strokes - only draw up to undo point
-                    if stroke.get('undone', False):
-                        undone_at = stroke.get('undoneAt')
-                        if undone_at:
-                            points_to_draw = [p for p in stroke['points'] if p['timestamp'] < undone_at]
-                        else:
-                            points_to_draw = []
-                    else:
-                        points_to_draw = stroke['points']
-                    
-                    if not points_to_draw:
-                        continue
-                    
-                    color = hex_to_rgb(stroke['color'])
-                    brush_size = stroke['brushSize']
-                    
-                    if len(points_to_draw) == 1:
-                        # Single point stroke (tap) - just draw the point
-                        pt = points_to_draw[0]
-                        left = pt['x'] - brush_size / 2
-                        top = pt['y'] - brush_size / 2
-                        right = pt['x'] + brush_size / 2
-                        bottom = pt['y'] + brush_size / 2
-                        draw.rectangle([left, top, right, bottom], fill=color)
-                    else:
-                        # Multi-point stroke - draw first point, then segments
-                        # Draw first point
-                        first_pt = points_to_draw[0]
-                        left = first_pt['x'] - brush_size / 2
-                        top = first_pt['y'] - brush_size / 2
-                        right = first_pt['x'] + brush_size / 2
-                        bottom = first_pt['y'] + brush_size / 2
-                        draw.rectangle([left, top, right, bottom], fill=color)
-                        
-                        # Draw segments between points
-                        for i in range(1, len(points_to_draw)):
-                            start_pt = (points_to_draw[i-1]['x'], points_to_draw[i-1]['y'])
-                            end_pt = (points_to_draw[i]['x'], points_to_draw[i]['y'])
-                            draw_stroke_segment(draw, start_pt, end_pt, color, brush_size)
-            
-            # Draw point
-            if point_idx == 0:
-                # First point - just draw it
-                x = point_data['x']
-                y = point_data['y']
-                left = x - point_data['brush_size'] / 2
-                top = y - point_data['brush_size'] / 2
-                right = x + point_data['brush_size'] / 2
-                bottom = y + point_data['brush_size'] / 2
-                draw.rectangle([left, top, right, bottom], fill=point_data['color'])
-            else:
-                # Draw line from previous point
-                stroke = point_data['stroke']
-                prev_point = stroke['points'][point_idx - 1]
-                start_pt = (prev_point['x'], prev_point['y'])
-                end_pt = (point_data['x'], point_data['y'])
-                draw_stroke_segment(draw, start_pt, end_pt, point_data['color'], point_data['brush_size'])
-            
-            active_strokes[stroke_id] = point_idx
-            
-            # Check if stroke is complete
-            stroke = point_data['stroke']
-            if point_idx == len(stroke['points']) - 1:
-                completed_strokes.add(stroke_id)
-                if stroke_id in active_strokes:
-                    del active_strokes[stroke_id]
-                # For single-point strokes, ensure they're immediately visible
-                if len(stroke['points']) == 1:
-                    # Already drawn above, but ensure it stays visible
-                    pass
-            
-            current_point_index += 1
+        # Calculate target time for this frame; the last frame always reaches
+        # the end so no trailing points are left undrawn
+        if frame_num == total_frames - 1:
+            frame_time = end_time
+        else:
+            frame_time = start_time + (frame_num * frame_interval_ms)
+        
+        # Draw all points up to current time onto the persistent canvas;
+        # a binary search finds where this frame's batch of points ends.
+        # Idle frames (next point still in the future) skip the search.
+        if ts[current_point_index] > frame_time:
+            end_idx = current_point_index
+        else:
+            end_idx = int(np.searchsorted(ts, frame_time, side='right'))
+        dirty_rect = None  # Canvas region drawn during this frame
         
-        # If all points are processed, ensure all strokes are drawn in remaining frames
-        if current_point_index >= len(all_points):
-            if not all_points_processed:
-                all_points_processed = True
-                print(f"All points processed. Redrawing all {len(strokes)} strokes...")
-            # Always redraw everything in remaining frames to ensure all strokes are visible (excluding undone parts)
-            canvas = Image.new('RGB', (CANVAS_SIZE, CANVAS_SIZE), bg_color)
-            draw = ImageDraw.Draw(canvas)
-            # Sort strokes by timestamp to maintain proper layering
-            sorted_strokes = sorted(strokes, key=lambda s: s['timestamp'])
-            for stroke in sorted_strokes:
-                # Handle undone strokes - only draw up to undo point
-                if stroke.get('undone', False):
-                    undone_at = stroke.get('undoneAt')
-                    if undone_at:
-                        points_to_draw = [p for p in stroke['points'] if p['timestamp'] < undone_at]
-                    else:
-                        points_to_draw = []
-                else:
-                    points_to_draw = stroke['points']
+        if end_idx > current_point_index:
+            # Split the batch into runs of consecutive points from the same
+            # stroke and draw each run with a single polyline call
+            run_starts = np.flatnonzero(np.diff(stroke_idx[current_point_index:end_idx])) + 1 + current_point_index
+            run_bounds = [current_point_index, *run_starts.tolist(), end_idx]
+            for a, b in zip(run_bounds[:-1], run_bounds[1:]):
+                s = int(stroke_idx[a])
+                color = stroke_colors[s].tolist()
+                brush_size = int(stroke_brush[s])
+                run_pts = np.stack((xs[a:b], ys[a:b]), axis=1)
                 
-                if not points_to_draw:
-                    continue
+                prev = last_xy.get(s)
+                if prev is not None:
+                    # Continue from the stroke's previous point
+                    run_pts = np.vstack((prev, run_pts))
+                
+                # Only rasterize within the stroke's bounding box
+                x0, y0, x1, y1 = stroke_bboxes[s].tolist()
+                roi = canvas[y0:y1, x0:x1]
+                roi_pts = run_pts - (x0, y0)
+                if prev is None:
+                    # First point - just draw it
+                    draw_brush_point(roi, roi_pts[0], color, brush_size)
+                draw_stroke_polyline(roi, roi_pts, color, brush_size)
                 
-                color = hex_to_rgb(stroke['color'])
-                brush_size = stroke['brushSize']
+                last_xy[s] = run_pts[-1]
                 
-                if len(points_to_draw) == 1:
-                    # Single point stroke (tap)
-                    pt = points_to_draw[0]
-                    left = pt['x'] - brush_size / 2
-                    top = pt['y'] - brush_size / 2
-                    right = pt['x'] + brush_size / 2
-                    bottom = pt['y'] + brush_size / 2
-                    draw.rectangle([left, top, right, bottom], fill=color)
-                else:
-                    # Multi-point stroke
-                    first_pt = points_to_draw[0]
-                    left = first_pt['x'] - brush_size / 2
-                    top = first_pt['y'] - brush_size / 2
-                    right = first_pt['x'] + brush_size / 2
-                    bottom = first_pt['y'] + brush_size / 2
-                    draw.rectangle([left, top, right, bottom], fill=color)
-                    
-                    for i in range(1, len(points_to_draw)):
-                        start_pt = (points_to_draw[i-1]['x'], points_to_draw[i-1]['y'])
-                        end_pt = (points_to_draw[i]['x'], points_to_draw[i]['y'])
-                        draw_stroke_segment(draw, start_pt, end_pt, color, brush_size)
+                half = brush_size / 2
+                dirty_rect = union_rect(dirty_rect, (
+                    max(0, int(run_pts[:, 0].min() - half)),
+                    max(0, int(run_pts[:, 1].min() - half)),
+                    min(CANVAS_SIZE, int(run_pts[:, 0].max() + half) + 1),
+                    min(CANVAS_SIZE, int(run_pts[:, 1].max() + half) + 1),
+                ))
+            
+            stale_rects = [union_rect(rect, dirty_rect) for rect in stale_rects]
         
-        # Convert PIL image to OpenCV format and write frame
-        frame = cv2.cvtColor(np.array(canvas), cv2.COLOR_RGB2BGR)
-        video_writer.write(frame)
+        current_point_index = end_idx
         
-        if (frame_num + 1) % 30 == 0:
-            progress = (frame_num + 1) / total_frames * 100
-            print(f"Progress: {progress:.1f}% ({frame_num + 1}/{total_frames} frames)")
-    
-    # Final frame: ensure all strokes are drawn in chronological order (excluding undone parts)
-    canvas = Image.new('RGB', (CANVAS_SIZE, CANVAS_SIZE), bg_color)
-    draw = ImageDraw.Draw(canvas)
-    # Sort strokes by timestamp to maintain proper layering
-    sorted_strokes = sorted(strokes, key=lambda s: s['timestamp'])
-    for stroke in sorted_strokes:
-        # Skip undone strokes entirely, or only draw up to undo point
-        if stroke.get('undone', False):
-            undone_at = stroke.get('undoneAt')
-            if undone_at:
-                # Only draw points before undo timestamp
-                points_to_draw = [p for p in stroke['points'] if p['timestamp'] < undone_at]
+        if current_point_index >= num_points:
+            # Nothing changes from here on: write the finished canvas for the
+            # remaining frames plus the hold instead of redrawing it per frame
+            remaining_frames = total_frames - frame_num - 1
+            print(f"All points processed. Writing final frame for {remaining_frames + HOLD_FRAMES} frames...")
+            final_frame = canvas
+            if isinstance(video_writer, FFmpegWriter):
+                hold_frames = 0  # ffmpeg clones the last frame itself
             else:
-                # If no undo timestamp, skip the stroke entirely
-                continue
-        else:
-            points_to_draw = stroke['points']
+                hold_frames = HOLD_FRAMES
+            for _ in range(remaining_frames + 1 + hold_frames):  # Includes this frame
+                frame_queue.put(final_frame)
+            break
         
-        if not points_to_draw:
-            continue
-            
-        color = hex_to_rgb(stroke['color'])
-        brush_size = stroke['brushSize']
-        color = hex_to_rgb(stroke['color'])
-        points = stroke['points']
-        brush_size = stroke['brushSize']
+        # The writer thread encodes a snapshot while the canvas keeps changing;
+        # only take a new one when this frame drew something
+        if dirty_rect is not None or frame is None:
+            k = snapshot_count % len(frame_buffers)
+            frame = frame_buffers[k]
+            if stale_rects[k] is not None:
+                x0, y0, x1, y1 = stale_rects[k]
+                frame[y0:y1, x0:x1] = canvas[y0:y1, x0:x1]
+                stale_rects[k] = None
+            snapshot_count += 1
+        frame_queue.put(frame)
         
-        if len(points) == 1:
-            pt = points[0]
-            left = pt['x'] - brush_size / 2
-            top = pt['y'] - brush_size / 2
-            right = pt['x'] + brush_size / 2
-            bottom = pt['y'] + brush_size / 2
-            draw.rectangle([left, top, right, bottom], fill=color)
-        else:
-            first_pt = points[0]
-            left = first_pt['x'] - brush_size / 2
-            top = first_pt['y'] - brush_size / 2
-            right = first_pt['x'] + brush_size / 2
-            bottom = first_pt['y'] + brush_size / 2
-            draw.rectangle([left, top, right, bottom], fill=color)
-            
-            for i in range(1, len(points)):
-                start_pt = (points[i-1]['x'], points[i-1]['y'])
-                end_pt = (points[i]['x'], points[i]['y'])
-                draw_stroke_segment(draw, start_pt, end_pt, color, brush_size)
-    
-    # Write final frame multiple times to ensure it's visible
-    final_frame = cv2.cvtColor(np.array(canvas), cv2.COLOR_RGB2BGR)
-    for _ in range(30):  # Hold final frame for 1 second
-        video_writer.write(final_frame)
+        if (frame_num + 1) % 30 == 0:
+            progress = (frame_num + 1) / total_frames * 100
+            print(f"Progress: {progress:.1f}% ({frame_num + 1}/{total_frames} frames)")
     
+    frame_queue.put(None)
+    writer_thread.join()
     video_writer.release()
+    if writer_errors:
+        raise writer_errors[0]
     print(f"Video saved to: {output_path}")
     print(f"Total strokes rendered: {len(strokes)}")
 